@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
-import csv
+import hashlib
+import math
+import os
+import pickle
+import re
 from argparse import ArgumentParser, Namespace
-from datetime import datetime, timedelta
+from collections.abc import Iterable
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import Any, Self
 
@@ -10,6 +15,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import polars as pl
 import seaborn as sns
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties, findfont
 from PIL import Image
 from PIL.Image import Image as ImageType
 from tqdm import tqdm
@@ -17,7 +24,10 @@ from tqdm import tqdm
 pl.Config.set_tbl_hide_dataframe_shape(True)
 pl.Config.set_tbl_hide_column_data_types(True)
 DEBUG: bool = False
-mpl.rcParams["font.family"] = "Noto Sans JP"
+FONT_FAMILY: str = "Noto Sans JP"
+# safe after importing pyplot: the backend is resolved on first use
+mpl.use("Agg")
+mpl.rcParams["font.family"] = FONT_FAMILY
 
 
 class WindRose:
@@ -26,6 +36,8 @@ class WindRose:
     wind_path: Path = Path("wind.csv")
     map_path: Path = Path("map.png")
     fig_dir_path: Path = Path("diagrams")
+    cache_dir_path: Path = fig_dir_path / ".cache"
+    cache_version: int = 1
     directions: list[str] = [
         "北",
         "北北東",
@@ -45,6 +57,11 @@ class WindRose:
         "北北西",
         "静穏",
     ]
+    quarter_turns: dict[int, Image.Transpose] = {
+        90: Image.Transpose.ROTATE_90,
+        180: Image.Transpose.ROTATE_180,
+        270: Image.Transpose.ROTATE_270,
+    }
     color_palette: list[tuple[float, float, float]] = sns.hls_palette(
         13,
         l=0.5,
@@ -59,96 +76,156 @@ class WindRose:
         self.direction_to_index: dict[str, int] = {
             d: i for i, d in enumerate(self.directions)
         }
-        # read wind data
+        # direction prefix/suffix patterns used by read_wind
+        # (longest direction first)
+        directions_pattern: str = "|".join(
+            map(re.escape, sorted(self.directions, key=len, reverse=True))
+        )
+        self._prefix_pattern: str = f"^({directions_pattern})"
+        self._suffix_pattern: str = f"({directions_pattern})$"
+        # check input files
         if not self.wind_path.is_file():
             raise FileNotFoundError(f"'{self.wind_path}' not found.")
-        self.read_wind()
+        if not self.map_path.is_file():
+            raise FileNotFoundError(f"'{self.map_path}' not found.")
         # set angle
         while angle < 0:
             angle += 360
         while angle >= 360:
             angle -= 360
         self.angle: int = angle
-        # read map
-        if not self.map_path.is_file():
-            raise FileNotFoundError(f"'{self.map_path}' not found.")
-        self.read_map()
-        return
-
-    def parse_wind_direction(self: Self, raw: str) -> int:
-        raw_starts: bool = raw == "" or raw.startswith(tuple(self.directions))
-        raw_ends: bool = raw == "" or raw.endswith(tuple(self.directions))
-        if raw_starts ^ raw_ends:
-            if raw_starts:
-                while True:
-                    raw = raw[:-1]
-                    if raw in self.directions:
-                        break
-                    elif raw == "":
-                        raise ValueError("Invalid direction")
-            else:  # raw_ends
-                while True:
-                    raw = raw[1:]
-                    if raw in self.directions:
-                        break
-                    elif raw == "":
-                        raise ValueError("Invalid direction")
-        return (
-            self.direction_to_index["静穏"]
-            if raw == ""
-            else self.direction_to_index[raw]
+        # angles of directions on the polar axes (closed for plotting)
+        base_angles: np.ndarray = (
+            (0.25 - np.arange(16) / 16.0 + self.angle / 360.0) * 2.0 * np.pi
+        )
+        self._angles: np.ndarray = np.mod(base_angles, 2.0 * np.pi)
+        self._angles_closed: np.ndarray = np.concatenate(
+            [self._angles, self._angles[:1]]
         )
+        self._direction_labels: list[str] = self.directions[:-1]
+        # read wind data and map (or restore them from the cache)
+        cache_key: str = hashlib.blake2b(
+            (
+                f"{self.wind_path.stat().st_mtime_ns}"
+                f"|{self.map_path.stat().st_mtime_ns}"
+                f"|{self.angle}"
+                f"|{self.cache_version}"
+            ).encode()
+        ).hexdigest()[:16]
+        if not self.load_cache(key=cache_key):
+            self.read_wind()
+            self.read_map()
+            self.save_cache(key=cache_key)
+        # figure shared by the charts drawn in this process (created lazily)
+        self._fig: Figure | None = None
+        self._ax: Any = None
+        return
 
     def read_wind(self: Self) -> None:
-        wind_data: list[dict[str, Any]] = []
-        with open(self.wind_path, encoding="utf-8-sig") as wind_f:
-            wind_reader: csv.reader = csv.reader(wind_f, delimiter=",")
-            for row in wind_reader:
-                try:
-                    dt: datetime = datetime.strptime(
-                        row[0].strip(),
-                        "%Y/%m/%d %H:%M:%S",
-                    )
-                    dt -= timedelta(hours=1)
-                    day: datetime = dt.replace(
-                        hour=0,
-                        minute=0,
-                        second=0,
-                        microsecond=0,
-                    )
-                    month: int = dt.month
-                    row1: str = row[1].strip()
-                    wind: float = 0 if row1 == "" else float(row1)
-                    row3: str = row[3].strip()
-                    direction_index: int = self.parse_wind_direction(raw=row3)
-                except Exception as e:
-                    print(row)
-                    raise e
-                wind_data.append(
-                    {
-                        "datetime": dt,
-                        "day": day,
-                        "month": month,
-                        "wind": wind,
-                        "direction_index": direction_index,
-                    }
+        raw_df: pl.DataFrame = pl.read_csv(
+            self.wind_path,
+            has_header=False,
+            encoding="utf8-lossy",
+            columns=[0, 1, 3],
+            new_columns=["timestamp", "wind", "direction"],
+            infer_schema=False,
+        )
+        raw_df = raw_df.with_columns(
+            datetime=pl.col("timestamp")
+            .str.strip_chars()
+            .str.strptime(pl.Datetime("us"), "%Y/%m/%d %H:%M:%S")
+            .dt.offset_by("-1h"),
+            wind=pl.col("wind")
+            .str.strip_chars()
+            .replace("", None)
+            .cast(pl.Float64)
+            .fill_null(0.0),
+            direction=pl.col("direction").str.strip_chars().fill_null(""),
+        )
+        raw_df = raw_df.with_columns(
+            day=pl.col("datetime").dt.truncate("1d"),
+            month=pl.col("datetime").dt.month(),
+            direction_index=pl.when(pl.col("direction") == "")
+            .then(pl.lit("静穏"))
+            .otherwise(
+                pl.col("direction")
+                .str.extract(self._prefix_pattern, 1)
+                .fill_null(
+                    pl.col("direction").str.extract(self._suffix_pattern, 1)
                 )
-        raw_df: pl.DataFrame = pl.DataFrame(wind_data)
-        counts_df: pl.DataFrame = raw_df.group_by(["month"]).agg(
-            nhours=pl.len(),
+            )
+            .replace_strict(
+                self.direction_to_index,
+                default=None,
+                return_dtype=pl.Int64,
+            ),
+        )
+        invalid_df: pl.DataFrame = raw_df.filter(
+            pl.col("direction_index").is_null()
+        )
+        if invalid_df.height > 0:
+            print(invalid_df.select(["timestamp", "wind", "direction"]))
+            raise ValueError("Invalid direction")
+        raw_df = raw_df.select(
+            ["datetime", "day", "month", "wind", "direction_index"]
         )
-        raw_df = raw_df.join(counts_df, on="month", how="left")
-        data_df: pl.DataFrame = raw_df.group_by(
-            [
+        data_df: pl.DataFrame = (
+            raw_df.group_by(
+                [
+                    "month",
+                    "direction_index",
+                ]
+            )
+            .agg(
+                count=pl.len(),
+                wind_mean=pl.col("wind").mean(),
+                wind_max=pl.col("wind").max(),
+            )
+            .select(
                 "month",
                 "direction_index",
-            ]
-        ).agg(
-            wind_percentage=pl.len() / pl.col("nhours").first() * 100.0,
-            wind_mean=pl.col("wind").mean(),
-            wind_max=pl.col("wind").max(),
+                wind_percentage=pl.col("count")
+                / pl.col("count").sum().over("month")
+                * 100.0,
+                wind_mean=pl.col("wind_mean"),
+                wind_max=pl.col("wind_max"),
+            )
         )
         self.data_df = data_df.fill_nan(0)
+        # direction x month matrices (calm is not drawn)
+        direction_df: pl.DataFrame = pl.DataFrame(
+            {"direction_index": list(range(16))},
+            schema={"direction_index": pl.Int64},
+        )
+        self._pivots: dict[str, np.ndarray] = {}
+        self._pivots_closed: dict[str, np.ndarray] = {}
+        for column in ["wind_percentage", "wind_mean", "wind_max"]:
+            pivot_df: pl.DataFrame = direction_df.join(
+                self.data_df.filter(pl.col("direction_index") < 16).pivot(
+                    index="direction_index",
+                    on="month",
+                    values=column,
+                ),
+                on="direction_index",
+                how="left",
+            )
+            self._pivots[column] = (
+                pivot_df.select(
+                    [
+                        (
+                            pl.col(str(month))
+                            if str(month) in pivot_df.columns
+                            else pl.lit(None, dtype=pl.Float64)
+                        ).alias(str(month))
+                        for month in range(1, 13)
+                    ]
+                )
+                .fill_null(0)
+                .to_numpy()
+            )
+            self._pivots_closed[column] = np.vstack(
+                [self._pivots[column], self._pivots[column][:1]]
+            )
         return
 
     def center_crop(
@@ -158,6 +235,8 @@ class WindRose:
         height: int,
     ) -> ImageType:
         orig_width, orig_height = orig.size
+        if orig_width == width and orig_height == height:
+            return orig.convert("RGB")
         crop_left: int = (orig_width - width) // 2 if orig_width > width else 0
         crop_top: int = (
             (orig_height - height) // 2 if orig_height > height else 0
@@ -178,28 +257,128 @@ class WindRose:
 
     def read_map(self: Self) -> None:
         raw_map: ImageType = Image.open(self.map_path).convert("RGBA")
-        raw_width, raw_height = raw_map.size
-        cropped_map: ImageType = self.center_crop(
-            orig=raw_map,
-            width=640,
-            height=640,
-        ).rotate(self.angle)
+        map_size: int = 450
+        if self.angle % 90 == 0:
+            # exact quarter turns need neither margin nor resampling
+            map_image: ImageType = self.center_crop(
+                orig=raw_map,
+                width=map_size,
+                height=map_size,
+            )
+            if self.angle != 0:
+                map_image = map_image.transpose(self.quarter_turns[self.angle])
+        else:
+            # margin to keep the rotated corners inside the map
+            # (even size so that the center stays on the same pixel)
+            rotate_size: int = 2 * math.ceil(map_size * math.sqrt(2) / 2)
+            offset: int = (rotate_size - map_size) // 2
+            map_image = (
+                self.center_crop(
+                    orig=raw_map,
+                    width=rotate_size,
+                    height=rotate_size,
+                )
+                .rotate(
+                    self.angle,
+                    resample=Image.Resampling.BILINEAR,
+                    expand=False,
+                    fillcolor=(255, 255, 255),
+                )
+                .crop((offset, offset, offset + map_size, offset + map_size))
+            )
         background: ImageType = Image.new(
             "RGB",
             (550, 450),
             (255, 255, 255),
         )
-        background.paste(
-            self.center_crop(
-                orig=cropped_map,
-                width=450,
-                height=450,
-            ),
-            (0, 0),
-        )
+        background.paste(map_image, (0, 0))
         self.map_image: ImageType = background
         return
 
+    def load_cache(self: Self, key: str) -> bool:
+        data_path: Path = self.cache_dir_path / f"{key}.arrow"
+        extra_path: Path = self.cache_dir_path / f"{key}.pkl"
+        if not (data_path.is_file() and extra_path.is_file()):
+            return False
+        # a broken cache is rebuilt rather than stopping the run
+        try:
+            data_df: pl.DataFrame = pl.read_ipc(data_path)
+            with open(extra_path, "rb") as extra_f:
+                extra: dict[str, Any] = pickle.load(extra_f)
+            pivots: dict[str, np.ndarray] = extra["pivots"]
+            pivots_closed: dict[str, np.ndarray] = extra["pivots_closed"]
+            map_image: ImageType = Image.frombytes(
+                extra["map_mode"],
+                extra["map_size"],
+                extra["map"],
+            )
+        except Exception:
+            return False
+        self.data_df = data_df
+        self._pivots = pivots
+        self._pivots_closed = pivots_closed
+        self.map_image = map_image
+        return True
+
+    def save_cache(self: Self, key: str) -> None:
+        # keep only the cache for the current inputs
+        if self.cache_dir_path.is_dir():
+            for stale_path in self.cache_dir_path.iterdir():
+                if stale_path.is_file():
+                    stale_path.unlink(missing_ok=True)
+        else:
+            self.cache_dir_path.mkdir(parents=True, exist_ok=True)
+        # write to temporary files and move them into place, pickle last,
+        # so that an interrupted write never leaves a complete-looking cache
+        data_path: Path = self.cache_dir_path / f"{key}.arrow"
+        extra_path: Path = self.cache_dir_path / f"{key}.pkl"
+        data_temp_path: Path = data_path.with_suffix(".arrow.tmp")
+        extra_temp_path: Path = extra_path.with_suffix(".pkl.tmp")
+        self.data_df.write_ipc(data_temp_path)
+        with open(extra_temp_path, "wb") as extra_f:
+            pickle.dump(
+                {
+                    "pivots": self._pivots,
+                    "pivots_closed": self._pivots_closed,
+                    "map": self.map_image.tobytes(),
+                    "map_mode": self.map_image.mode,
+                    "map_size": self.map_image.size,
+                },
+                extra_f,
+                protocol=5,
+            )
+        os.replace(data_temp_path, data_path)
+        os.replace(extra_temp_path, extra_path)
+        return
+
+    def create_figure(self: Self) -> None:
+        self._fig, self._ax = plt.subplots(
+            nrows=1,
+            ncols=1,
+            figsize=(5.5, 4.5),
+            dpi=100,
+            layout=None,
+            subplot_kw={"projection": "polar"},
+        )
+        # fixed layout leaving room for the legend on the right
+        # (close to what tight layout chose with the fallback font)
+        self._fig.subplots_adjust(
+            left=0.03, right=0.83, bottom=0.095, top=0.905
+        )
+        self._fig.patch.set_facecolor("none")
+        # resolve fonts once instead of on every chart
+        self._tick_font: FontProperties = FontProperties(
+            family=FONT_FAMILY,
+            size=12,
+        )
+        self._legend_font: FontProperties = FontProperties(
+            family=FONT_FAMILY,
+            size=10,
+        )
+        findfont(self._tick_font)
+        findfont(self._legend_font)
+        return
+
     def create_lader_chart(
         self: Self,
         column: str,
@@ -211,60 +390,42 @@ class WindRose:
             "wind_mean",
             "wind_max",
         ]
-        valid_direction_indexes: list[int] = list(range(16))
-        values_dict: dict[int, list[float]] = {}
-        for month in months:
-            temp_df: pl.DataFrame = (
-                self.data_df.select(
-                    [
-                        "month",
-                        "direction_index",
-                        column,
-                    ]
-                )
-                .filter(
-                    pl.col("month") == month,
-                    pl.col("direction_index").is_in(valid_direction_indexes),
-                )
-                .sort(by="direction_index")
-            )
-            values: list[float] = (
-                temp_df.select(pl.col(column)).to_series().to_list()
-            )
-            values_dict[month] = values
-        angle_list: list[float] = [
-            (0.25 - (i / 16.0) + (self.angle / 360)) * 2.0 * np.pi
-            for i in range(16)
-        ]
-        angle_list = [x + (2.0 * np.pi) if x < 0 else x for x in angle_list]
-        angle_list = [
-            x - (2.0 * np.pi) if x >= 2.0 * np.pi else x for x in angle_list
-        ]
-        angle_list += angle_list[:1]
-        fig, ax = plt.subplots(
-            nrows=1,
-            ncols=1,
-            figsize=(5.5, 4.5),
-            dpi=100,
-            layout="tight",
-            subplot_kw={"projection": "polar"},
+        pivot_closed: np.ndarray = self._pivots_closed[column]
+        if self._fig is None:
+            self.create_figure()
+        fig, ax = self._fig, self._ax
+        ax.clear()
+        ax.set_facecolor("none")
+        ax.set_xticks(self._angles)
+        ax.set_xticklabels(
+            self._direction_labels,
+            fontproperties=self._tick_font,
         )
-        # plt.imshow(self.map_image)
-        plt.xticks(angle_list[:-1], self.directions[:-1], fontsize=12)
         for month in months:
-            draw_values: list[float] = values_dict[month]
-            draw_values += draw_values[:1]
             ax.plot(
-                angle_list,
-                draw_values,
+                self._angles_closed,
+                pivot_closed[:, month - 1],
                 linewidth=2,
                 label=f"{month}月",
                 color=self.color_palette[month - 1],
             )
-        plt.legend(bbox_to_anchor=(1.1, 0.95), loc="upper left", fontsize=10)
-        temp_path: Path = self.fig_dir_path / "_temp.png"
-        fig.savefig(temp_path, transparent=True)
-        plt.close()
+        ax.legend(
+            bbox_to_anchor=(1.1, 0.95),
+            loc="upper left",
+            prop=self._legend_font,
+        )
+        # render with transparent background into memory
+        fig.canvas.draw()
+        graph_width, graph_height = fig.canvas.get_width_height()
+        graph: ImageType = Image.frombuffer(
+            "RGBA",
+            (graph_width, graph_height),
+            np.asarray(fig.canvas.buffer_rgba()),
+            "raw",
+            "RGBA",
+            0,
+            1,
+        )
         # overlay graph on map
         rose: ImageType = Image.new(
             "RGB",
@@ -272,42 +433,95 @@ class WindRose:
             (255, 255, 255),
         )
         rose.paste(self.map_image, (0, 0))
-        graph: ImageType = Image.open(temp_path).convert("RGBA")
         rose.paste(graph, (-10, 0), graph)
-        rose.save(self.fig_dir_path / fname)
-        temp_path.unlink(missing_ok=True)
+        # diagrams favor fast encoding over file size
+        rose.save(
+            self.fig_dir_path / fname,
+            format="PNG",
+            compress_level=1,
+            optimize=False,
+        )
         return
 
+    def close_figure(self: Self) -> None:
+        if self._fig is not None:
+            plt.close(self._fig)
+        self._fig = None
+        self._ax = None
+        return
+
+    def render_charts(
+        self: Self,
+        charts: Iterable[tuple[str, list[int], str]],
+    ) -> int:
+        count: int = 0
+        try:
+            for column, months, fname in charts:
+                self.create_lader_chart(
+                    column=column,
+                    months=months,
+                    fname=fname,
+                )
+                count += 1
+        finally:
+            self.close_figure()
+        return count
+
     def generate(self) -> None:
-        # Placeholder for wind rose generation logic
         all_months: list[int] = list(range(1, 13))
-        for name, months in tqdm(
-            [
+        charts: list[tuple[str, list[int], str]] = [
+            (column, months, f"{column}_{name}.png")
+            for name, months in [
                 ("year", all_months),
                 ("summer", self.summer_months),
                 ("winter", self.winter_months),
-            ],
-            desc="[Season]",
-        ):
-            if len(months) == 0:
-                continue
-            for column in tqdm(
-                [
-                    "wind_percentage",
-                    "wind_mean",
-                    "wind_max",
-                ],
-                desc="[Type]",
-                leave=False,
-            ):
-                self.create_lader_chart(
-                    column=column,
-                    months=months,
-                    fname=f"{column}_{name}.png",
-                )
+            ]
+            if len(months) > 0
+            for column in [
+                "wind_percentage",
+                "wind_mean",
+                "wind_max",
+            ]
+        ]
+        max_workers: int = min(len(charts), os.cpu_count() or 1)
+        if max_workers == 1:
+            # a single worker would only add process startup cost
+            self.render_charts(charts=tqdm(charts, desc="[Chart]"))
+            return
+        # charts are independent, so draw them in parallel processes
+        # (one batch per worker, so that each figure is reused and closed)
+        batches: list[list[tuple[str, list[int], str]]] = [
+            charts[i::max_workers] for i in range(max_workers)
+        ]
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(self,),
+        ) as executor:
+            futures: list[Future[int]] = [
+                executor.submit(_render_charts, charts=batch)
+                for batch in batches
+            ]
+            with tqdm(total=len(charts), desc="[Chart]") as progress:
+                for future in as_completed(futures):
+                    progress.update(future.result())
         return
 
 
+_worker_wind_rose: WindRose | None = None
+
+
+def _init_worker(wind_rose: WindRose) -> None:
+    global _worker_wind_rose
+    _worker_wind_rose = wind_rose
+    return
+
+
+def _render_charts(charts: list[tuple[str, list[int], str]]) -> int:
+    assert _worker_wind_rose is not None
+    return _worker_wind_rose.render_charts(charts=charts)
+
+
 def main() -> None:
     parser: ArgumentParser = ArgumentParser(
         description="Generate wind rose diagrams.",